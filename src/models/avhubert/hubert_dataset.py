@@ -215,15 +215,13 @@ class AVHubertDataset(FairseqDataset):
         self.normalize = normalize
         if image_aug:
             self.transform = custom_utils.Compose([
-                custom_utils.Normalize( 0.0,255.0 ),
                 custom_utils.RandomCrop((image_crop_size, image_crop_size)),
                 custom_utils.HorizontalFlip(0.5),
-                custom_utils.Normalize(image_mean, image_std) ])
+                custom_utils.AffineNormalize(1.0 / (255.0 * image_std), -image_mean / image_std) ])
         else:
             self.transform = custom_utils.Compose([
-                custom_utils.Normalize( 0.0,255.0 ),
                 custom_utils.CenterCrop((image_crop_size, image_crop_size)),
-                custom_utils.Normalize(image_mean, image_std) ])
+                custom_utils.AffineNormalize(1.0 / (255.0 * image_std), -image_mean / image_std) ])
         logger.info(f"image transform: {self.transform}")
 
         logger.info(
@@ -265,12 +263,12 @@ class AVHubertDataset(FairseqDataset):
             Returns:
             feats - numpy.ndarray of shape [T', F']
             """
-            feat_dim = feats.shape[1]
-            if len(feats) % stack_order != 0:
-                res = stack_order - len(feats) % stack_order
-                res = np.zeros([res, feat_dim]).astype(feats.dtype)
-                feats = np.concatenate([feats, res], axis=0)
-            feats = feats.reshape((-1, stack_order, feat_dim)).reshape(-1, stack_order*feat_dim)
+            T, feat_dim = feats.shape
+            if T % stack_order != 0:
+                padded = np.zeros([-(-T // stack_order) * stack_order, feat_dim], dtype=feats.dtype)
+                padded[:T] = feats
+                feats = padded
+            feats = feats.reshape(-1, stack_order*feat_dim)
             return feats
         video_fn, audio_fn = mix_name
         if 'video' in self.modalities:
@@ -348,9 +346,6 @@ class AVHubertDataset(FairseqDataset):
     def __getitem__(self, index):
         video_feats, audio_feats = self.load_feature(self.names[index])
         audio_feats, video_feats = torch.from_numpy(audio_feats.astype(np.float32)) if audio_feats is not None else None, torch.from_numpy(video_feats.astype(np.float32)) if video_feats is not None else None
-        if self.normalize and 'audio' in self.modalities:
-            with torch.no_grad():
-                audio_feats = F.layer_norm(audio_feats, audio_feats.shape[1:])
         labels = self.get_labels(index)
         fid = self.names[index][1].split(':')[1]
         return {"id": index, 'fid': fid, "video_source": video_feats, 'audio_source': audio_feats, "label_list": labels}
@@ -393,6 +388,8 @@ class AVHubertDataset(FairseqDataset):
             audio_size = min(min(audio_sizes), self.max_sample_size)
         if audio_source is not None:
             collated_audios, padding_mask, audio_starts = self.collater_audio(audio_source, audio_size)
+            if self.normalize:
+                collated_audios = self.normalize_audio(collated_audios)
         else:
             collated_audios, audio_starts = None, None
         if video_source is not None:
@@ -429,7 +426,14 @@ class AVHubertDataset(FairseqDataset):
 
     def collater_audio(self, audios, audio_size, audio_starts=None):
         audio_feat_shape = list(audios[0].shape[1:])
-        collated_audios = audios[0].new_zeros([len(audios), audio_size]+audio_feat_shape)
+        # fill the buffer directly in its final layout, so no transposed copy of the batch is needed
+        # every row is fully written below, so there is no need to zero-fill the buffer first
+        if len(audio_feat_shape) == 1:
+            permute = (1, 0) # [T, F] -> [F, T]
+            collated_audios = audios[0].new_empty([len(audios)]+audio_feat_shape+[audio_size])
+        else:
+            permute = (3, 0, 1, 2) # [T, H, W, C] -> [C, T, H, W]
+            collated_audios = audios[0].new_empty([len(audios), audio_feat_shape[-1], audio_size]+audio_feat_shape[:-1])
         padding_mask = (
             torch.BoolTensor(len(audios), audio_size).fill_(False) # 
         )
@@ -438,23 +442,29 @@ class AVHubertDataset(FairseqDataset):
         for i, audio in enumerate(audios):
             diff = len(audio) - audio_size
             if diff == 0:
-                collated_audios[i] = audio
+                collated_audios[i] = audio.permute(permute)
             elif diff < 0:
                 assert self.pad_audio
-                collated_audios[i] = torch.cat(
-                    [audio, audio.new_full([-diff]+audio_feat_shape, 0.0)]
-                )
+                collated_audios[i, :, :diff] = audio.permute(permute)
+                collated_audios[i, :, diff:] = 0.0
                 padding_mask[i, diff:] = True
             else:
-                collated_audios[i], audio_starts[i] = self.crop_to_max_size(
+                audio, audio_starts[i] = self.crop_to_max_size(
                     audio, audio_size, audio_starts[i] if start_known else None
                 )
-        if len(audios[0].shape) == 2:
-            collated_audios = collated_audios.transpose(1, 2) # [B, T, F] -> [B, F, T]
-        else:
-            collated_audios = collated_audios.permute((0, 4, 1, 2, 3)).contiguous() # [B, T, H, W, C] -> [B, C, T, H, W]
+                collated_audios[i] = audio.permute(permute)
+        # [B, F, T] for audio, [B, C, T, H, W] for video
         return collated_audios, padding_mask, audio_starts
 
+    def normalize_audio(self, audios):
+        """
+        Per-frame layer norm over the features of the collated audio, done once per batch instead of per sample
+        Args:
+        audios - torch.Tensor of shape [B, F, T]
+        """
+        with torch.no_grad():
+            return F.layer_norm(audios.transpose(1, 2), audios.shape[1:2]).transpose(1, 2)
+
     def collater_frm_label(
         self, targets, audio_size, audio_starts, label_rate, pad
     ):
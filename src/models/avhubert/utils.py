@@ -101,6 +101,45 @@ class Normalize(object):
     def __repr__(self):
         return self.__class__.__name__+'(mean={0}, std={1})'.format(self.mean, self.std)
 
+class AffineNormalize(object):
+    """Normalize a ndarray image with a single affine map, e.g. a chain of Normalize folded into one pass.
+    """
+
+    def __init__(self, scale, bias):
+        self.scale = scale
+        self.bias = bias
+
+    def __call__(self, frames):
+        """
+        Args:
+            frames (numpy.ndarray): Images to be normalized.
+        Returns:
+            numpy.ndarray: Normalized images (frames * scale + bias) as float32.
+        """
+        # C order: the output is contiguous even when the input is a cropped or flipped view
+        out = np.multiply(frames, self.scale, dtype=np.float32, order='C')
+        out += self.bias
+        return out
+
+    def __repr__(self):
+        return self.__class__.__name__+'(scale={0}, bias={1})'.format(self.scale, self.bias)
+
+class ChannelFirst(object):
+    """Move the channel axis of the frames to the front, as a view.
+    """
+
+    def __call__(self, frames):
+        """
+        Args:
+            frames (numpy.ndarray): Images of shape (T, H, W, C).
+        Returns:
+            numpy.ndarray: Images of shape (C, T, H, W).
+        """
+        return frames.transpose(3, 0, 1, 2)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
 class CenterCrop(object):
     """Crop the given image at the center
     """
@@ -161,10 +200,9 @@ class HorizontalFlip(object):
         Returns:
             numpy.ndarray: Cropped image.
         """
-        t, h, w, ch = frames.shape
         if random.random() < self.flip_ratio:
-            for index in range(t):
-                frames[index] = cv2.flip(frames[index], 1)
+            # flipped view, so read-only (e.g. memory-mapped) frames can be flipped without a copy
+            frames = frames[:, :, ::-1]
         return frames
 
 def compute_mask_indices(
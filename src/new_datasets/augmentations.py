@@ -26,6 +26,30 @@ def shift_audio(data, shift_factor):
     return shifted_audio
 
 
+def read_shifted_audio(sound_file, shift_factor, num_samples, dtype="int16"):
+    """
+    Read the first num_samples of shift_audio(data, shift_factor) straight from disk,
+    without loading and rolling the whole signal
+    Args:
+    sound_file - soundfile.SoundFile opened for reading
+    Returns:
+    data - numpy.ndarray of shape [min(num_samples, N), C]
+    """
+    total = sound_file.frames
+    shift = int(shift_factor * total)
+    num_samples = min(num_samples, total)
+
+    # the shifted signal starts with the last `shift` samples, followed by the beginning of the signal
+    start = (total - shift) % total
+    sound_file.seek(start)
+    head = sound_file.read(frames=min(num_samples, total - start), dtype=dtype, always_2d=True)
+    if len(head) == num_samples:
+        return head
+    sound_file.seek(0)
+    tail = sound_file.read(frames=num_samples - len(head), dtype=dtype, always_2d=True)
+    return np.concatenate([head, tail], axis=0)
+
+
 def stacker(feats, stack_order):
     """
     Concatenating consecutive audio frames
@@ -35,10 +59,11 @@ def stacker(feats, stack_order):
     Returns:
     feats - numpy.ndarray of shape [T', F']
     """
-    feat_dim = feats.shape[1]
-    if len(feats) % stack_order != 0:
-        res = stack_order - len(feats) % stack_order
-        res = np.zeros([res, feat_dim]).astype(feats.dtype)
-        feats = np.concatenate([feats, res], axis=0)
-    feats = feats.reshape((-1, stack_order, feat_dim)).reshape(-1, stack_order * feat_dim)
+    T, feat_dim = feats.shape
+    if T % stack_order != 0:
+        # zero-pad to a multiple of stack_order with a single allocation
+        padded = np.zeros([-(-T // stack_order) * stack_order, feat_dim], dtype=feats.dtype)
+        padded[:T] = feats
+        feats = padded
+    feats = feats.reshape(-1, stack_order * feat_dim)
     return feats
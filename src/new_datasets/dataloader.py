@@ -9,21 +9,29 @@ import numpy
 import numpy as np
 import pandas as pd
 import python_speech_features
+import soundfile
 import torch
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities.types import EVAL_DATALOADERS, TRAIN_DATALOADERS
-from scipy.io import wavfile
 from scipy.signal import resample
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
 import models.avhubert.utils as custom_utils
 
 # from models.faceDetector.faceCropper import FaceCropper
-from new_datasets.augmentations import shift_audio, stacker
-from new_datasets.dataset_utils import split_new_dataset
+from new_datasets.augmentations import read_shifted_audio, shift_audio, stacker
+from new_datasets.dataset_utils import get_labels, label_keys, split_new_dataset
+from new_datasets.frontend import MFCCFrontend
+from new_datasets.prefetcher import CUDAPrefetcher
 
 mp.set_start_method("spawn", force=True)
 fps = 25.0
+image_mean = 0.421
+image_std = 0.165
+# Normalize(0, 255) followed by Normalize(image_mean, image_std), folded into one affine map.
+# Frames stay uint8 in the dataloader, the map is applied on the GPU (see FakeavcelebDataModule)
+image_scale = 1.0 / (255.0 * image_std)
+image_bias = -image_mean / image_std
 
 
 @dataclass
@@ -54,6 +62,23 @@ dtype = {
 }
 
 
+def save_atomic(path, save):
+    """
+    Write a file through a temporary file and os.replace, so that an interrupted write never
+    leaves a truncated file at path
+    Args:
+    save - callable writing the content to the given binary file object
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            save(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def seed_worker(worker_id):
     worker_seed = torch.initial_seed() % 2**32
     np.random.seed(worker_seed)
@@ -72,63 +97,95 @@ class Fakeavceleb(object):
         metadata: Optional[List[Metadata]] = None,
         # augmentation: bool = False,
         stack_audio=False,
+        raw_audio=False,
     ):
         # self.augmentation = augmentation
         self.root = root
         self.subset = subset
-        self.metadata = metadata
+        # only numpy arrays derived from metadata are kept, the DataFrame itself is not pickled to the workers
+        # labels : [N, len(label_keys)]
+        self.labels = get_labels(metadata)
 
-        self.image_mean = 0.421
-        self.image_std = 0.165
         self.numFrames = 30
         self.scale_percent = 0.5
         self.audio_shift = 0.2
 
         self.stack_order_audio = 4
         self.stack_audio = stack_audio
+        self.numcep = 26 if stack_audio else 13
+        # return the raw waveform and leave the MFCC extraction to MFCCFrontend
+        self.raw_audio = raw_audio
+        self.win_length = int(round(16_000 * 0.025 * 25 / fps))
+        self.hop_length = int(round(16_000 * 0.010 * 25 / fps))
+        # number of 16kHz samples covering exactly numFrames * 4 MFCC frames
+        self.num_samples = (self.numFrames * 4 - 1) * self.hop_length + self.win_length
+
+        # per-sample columns as plain numpy arrays, so __getitem__ never goes through pandas
+        rows = list(metadata.itertuples(index=False))
+        paths = [self.get_file_paths(row) for row in rows]
+        self.video_fns = np.array([video_fn for video_fn, _ in paths])
+        self.audio_fns = np.array([audio_fn for _, audio_fn in paths])
+        self.categories = metadata["category"].to_numpy()
+        self.files = np.array([os.path.join(row.path, row.vid) for row in rows])
 
         print(f"stack_audio: {self.stack_audio}")
 
         if self.subset in "train":
             self.transform = custom_utils.Compose(
                 [
-                    custom_utils.Normalize(0.0, 255.0),
                     custom_utils.RandomCrop((100, 100)),
                     custom_utils.HorizontalFlip(0.5),
-                    custom_utils.Normalize(self.image_mean, self.image_std),
+                    custom_utils.ChannelFirst(),
                 ]
             )
 
         else:
             self.transform = custom_utils.Compose(
                 [
-                    custom_utils.Normalize(0.0, 255.0),
                     custom_utils.CenterCrop((100, 100)),
-                    custom_utils.Normalize(self.image_mean, self.image_std),
+                    custom_utils.ChannelFirst(),
                 ]
             )
 
     def __getitem__(self, index):
-        meta = self.metadata.iloc[index]
-
-        c_label = 1 if ("RealVideo" in meta.type) and ("RealAudio" in meta.type) else 0
-        v_label = 1 if "RealVideo" in meta.type else 0
-        a_label = 1 if "RealAudio" in meta.type else 0
-        m_label = 1 if "real" in meta.method else 0
-
-        if "RealVideo-RealAudio" in meta.type:
-            mm_label = 0
-        elif "FakeVideo-RealAudio" in meta.type:
-            mm_label = 1
-        elif "RealVideo-FakeAudio" in meta.type:
-            mm_label = 2
-        else:
-            mm_label = 3
-        if meta.category == "B":
-            s_label = 0  # real_video-fake_audio
-        else:
-            s_label = 1
+        video, audio = self.load_features(self.video_fns[index], self.audio_fns[index], self.categories[index])
+        sample = {"id": index, "file": self.files[index]}
+        if self.raw_audio:
+            audio, sample["audio_length"] = audio
+
+        # if modified:
+        #     # assert self.augmentation
+        #     s_label = 0
+        #     m_label = 0
+
+        # video is uint8 and audio float32 already, so these wrap the arrays without copying
+        sample["video"] = torch.from_numpy(video)
+        sample["audio"] = torch.from_numpy(audio)
+        return sample
 
+    def __len__(self):
+        return len(self.video_fns)
+
+    def collater(self, samples):
+        ids = [s["id"] for s in samples]
+        # default_collate stacks into shared memory when called from a worker, saving a copy
+        batch = {
+            "id": torch.as_tensor(ids, dtype=torch.long),
+            "file": [s["file"] for s in samples],
+            "video": default_collate([s["video"] for s in samples]),
+            "audio": default_collate([s["audio"] for s in samples]),
+            "padding_mask": torch.zeros(len(samples), 1, dtype=torch.bool),
+        }
+        if self.raw_audio:
+            # number of valid samples of each waveform, see load_waveform
+            batch["audio_length"] = torch.as_tensor([s["audio_length"] for s in samples], dtype=torch.long)
+        # labels : [len(label_keys), B]
+        labels = torch.from_numpy(np.ascontiguousarray(self.labels[ids].T))
+        for key, label in zip(label_keys, labels):
+            batch[key] = label
+        return batch
+
+    def get_file_paths(self, meta):
         path = "/".join(meta.path.split("/")[1:])
         file_path = os.path.join(self.root, path, meta.vid)
 
@@ -142,84 +199,122 @@ class Fakeavceleb(object):
                 audio_fn = file_path.replace(".mp4", "_fake_sync.wav")
         else:
             audio_fn = file_path.replace(".mp4", ".wav")
-
-        video, audio = self.load_features(video_fn, audio_fn, meta.category)
-
-        # if modified:
-        #     # assert self.augmentation
-        #     s_label = 0
-        #     m_label = 0
-
-        return {
-            "id": index,
-            "file": os.path.join(meta.path, meta.vid),
-            "video": torch.FloatTensor(video),
-            "audio": torch.FloatTensor(audio),
-            "padding_mask": torch.tensor([False]),
-            "v_label": torch.tensor(v_label),
-            "a_label": torch.tensor(a_label),
-            "c_label": torch.tensor(c_label),
-            "m_label": torch.tensor(m_label),
-            "mm_label": torch.tensor(mm_label),
-            "s_label": torch.tensor(s_label),
-        }
-
-    def __len__(self):
-        return self.metadata.shape[0]
+        return video_fn, audio_fn
+
+    def audio_cache_path(self, audio_path, category):
+        # category F is shifted before feature extraction, so it gets its own cache file
+        suffix = "_shifted" if category == "F" else ""
+        return audio_path.replace(".wav", f"{suffix}_mfcc{self.numcep}.npy")
+
+    def video_cache_path(self, video_path):
+        return video_path.replace(".mp4", f"_frames{self.numFrames}_scale{self.scale_percent}.npy")
+
+    def precompute_features(self):
+        """
+        Decode the frames and extract the MFCC features of every sample once and save them as .npy
+        next to the .mp4 / .wav, so that load_video and load_audio can memory-map them instead of
+        recomputing them every epoch.
+        """
+        for video_fn, audio_fn, category in zip(self.video_fns, self.audio_fns, self.categories):
+            cache_path = self.video_cache_path(video_fn)
+            if not os.path.exists(cache_path):
+                frames = self.__load_video(video_fn, self.scale_percent)
+                save_atomic(cache_path, lambda f: np.save(f, frames))
+            if self.raw_audio:
+                continue
+            cache_path = self.audio_cache_path(audio_fn, category)
+            if not os.path.exists(cache_path):
+                audio = self.extract_audio_features(audio_fn, category)
+                save_atomic(cache_path, lambda f: np.save(f, audio))
 
     def load_features(self, video_fn, audio_fn, category):
 
-        audio = self.load_audio(audio_fn, category)
+        if self.raw_audio:
+            audio = self.load_waveform(audio_fn, category)
+        else:
+            audio = self.load_audio(audio_fn, category)
 
         video = self.load_video(video_fn)
 
         return video, audio
 
     def load_audio(self, audio_path, category):
-        sample_rate, audio = wavfile.read(audio_path)
-        if len(audio.shape) > 1:
-            audio = audio[:, 0]
+        maxAudio = int(
+            self.numFrames * 4
+        )  # audio frame is 10*25/fps ms long, visual frame is 1000/fps ms long
 
-        # if category is F and subset is test, we apply augmentation
-        if category == "F":
-            assert self.subset in "test"
-            audio = shift_audio(audio, self.audio_shift)
+        cache_path = self.audio_cache_path(audio_path, category)
+        if os.path.exists(cache_path):
+            # copy only the frames in use out of the memory-mapped (float32, read-only) cache
+            audio = np.array(np.load(cache_path, mmap_mode="r")[:maxAudio])
+        else:
+            audio = self.extract_audio_features(audio_path, category, self.num_samples)
 
-        if sample_rate != 16_000:
-            num_samples = round(len(audio) * float(16_000) / sample_rate)
-            audio = resample(audio, num_samples)
-            sample_rate = 16000
+        if audio.shape[0] < maxAudio:
+            shortage = maxAudio - audio.shape[0]
+            audio = numpy.pad(audio, ((0, shortage), (0, 0)), "wrap")
 
-        assert sample_rate == 16_000
+        # audio : [T[numFrames*4], F], float32
+        audio = audio[:maxAudio, :]
 
-        # fps is not always 25, in order to align the visual, we modify the window and step in MFCC extraction process based on fps
         if self.stack_audio:
-            numcep = 26
-        else:
-            numcep = 13
+            audio = stacker(audio, self.stack_order_audio)
+            audio = audio.transpose(1, 0)
+
+        return audio
+
+    def load_waveform(self, audio_path, category):
+        audio = self.read_audio(audio_path, category, self.num_samples)[: self.num_samples]
+        length = len(audio)
+        # zero-pad rather than wrap the samples, MFCCFrontend wrap-pads the MFCC frames like load_audio
+        if length < self.num_samples:
+            audio = numpy.pad(audio, (0, self.num_samples - length))
+
+        # audio : [S], float32 (resampled audio is float64, the rest int16)
+        return audio.astype(numpy.float32), length
 
+    def extract_audio_features(self, audio_path, category, num_samples=None):
+        audio = self.read_audio(audio_path, category, num_samples)
+
+        # fps is not always 25, in order to align the visual, we modify the window and step in MFCC extraction process based on fps
         audio = python_speech_features.mfcc(
-            audio, 16000, numcep=numcep, winlen=0.025 * 25 / fps, winstep=0.010 * 25 / fps
+            audio, 16000, numcep=self.numcep, winlen=0.025 * 25 / fps, winstep=0.010 * 25 / fps
         )
         # audio = python_speech_features.logfbank(
         #     audio, 16000, winlen=0.025 * 25 / fps, winstep=0.010 * 25 / fps,
         # )
 
-        maxAudio = int(
-            self.numFrames * 4
-        )  # audio frame is 10*25/fps ms long, visual frame is 1000/fps ms long
+        # audio : [T, F]
+        return audio.astype(numpy.float32)
 
-        if audio.shape[0] < maxAudio:
-            shortage = maxAudio - audio.shape[0]
-            audio = numpy.pad(audio, ((0, shortage), (0, 0)), "wrap")
+    def read_audio(self, audio_path, category, num_samples=None):
+        """
+        Read the first channel of the wav at int16 scale, as wavfile.read did.
+        If num_samples is given, only that many samples are read from disk when no resampling
+        needs the whole signal.
+        """
+        # if category is F and subset is test, we apply augmentation
+        if category == "F":
+            assert self.subset in "test"
 
-        # audio : [T[numFrames*4], F]
-        audio = audio[: int(round(self.numFrames * 4)), :]
-        audio = audio.astype(numpy.float32)
+        with soundfile.SoundFile(audio_path) as f:
+            sample_rate = f.samplerate
+            partial = num_samples is not None and sample_rate == 16_000
+            if partial and category == "F":
+                audio = read_shifted_audio(f, self.audio_shift, num_samples, dtype="int16")[:, 0]
+            else:
+                frames = num_samples if partial else -1
+                audio = f.read(frames=frames, dtype="int16", always_2d=True)[:, 0]
 
-        if self.stack_audio:
-            audio = stacker(audio, self.stack_order_audio)
-            audio = audio.transpose(1, 0)
+        if category == "F" and not partial:
+            audio = shift_audio(audio, self.audio_shift)
+
+        if sample_rate != 16_000:
+            num_samples = round(len(audio) * float(16_000) / sample_rate)
+            audio = resample(audio, num_samples)
+            sample_rate = 16000
+
+        assert sample_rate == 16_000
 
         return audio
 
@@ -245,7 +340,7 @@ class Fakeavceleb(object):
 
         if frame_count < self.numFrames:
             shortage = self.numFrames - frame_count
-            frame_like_zero = np.zeros((dim[1], dim[0], 3))
+            frame_like_zero = np.zeros((dim[1], dim[0], 3), dtype=np.uint8)
             for _ in range(shortage):
                 frames.append(frame_like_zero)
 
@@ -254,10 +349,15 @@ class Fakeavceleb(object):
         return frames
 
     def load_video(self, video_name):
-        feats = self.__load_video(video_name, self.scale_percent)
+        cache_path = self.video_cache_path(video_name)
+        if os.path.exists(cache_path):
+            # feats : [T, H, W, C] uint8
+            feats = np.load(cache_path, mmap_mode="r")
+        else:
+            feats = self.__load_video(video_name, self.scale_percent)
 
-        feats = self.transform(feats)
-        feats = feats.transpose(3, 0, 1, 2)
+        # feats : [C, T, H, W] uint8, the only copy of the cropped frames
+        feats = np.ascontiguousarray(self.transform(feats))
         return feats
 
     def load_visual(self, dataPath, aug=False):
@@ -318,6 +418,9 @@ class FakeavcelebDataModule(LightningDataModule):
         dataset_type: str = "new",
         test_subset: str = "all",
         stack_audio=False,
+        cache_features=False,
+        gpu_features=False,
+        cuda_prefetch=False,
         # mask_face=True,
     ):
         print("batch_size", batch_size)
@@ -326,6 +429,9 @@ class FakeavcelebDataModule(LightningDataModule):
         self.root = root
         self.batch_size = batch_size
         self.num_workers = num_workers
+        # keep workers alive between epochs and let each of them queue a few batches ahead
+        self.persistent_workers = num_workers > 0
+        self.prefetch_factor = 4 if num_workers > 0 else None
         self.take_train = take_train
         self.take_dev = take_dev
         self.take_test = take_test
@@ -337,11 +443,79 @@ class FakeavcelebDataModule(LightningDataModule):
         self.dataset_type = dataset_type
         self.test_subset = test_subset
         self.stack_audio = stack_audio
+        self.cache_features = cache_features
+        self.gpu_features = gpu_features
+        self.cuda_prefetch = cuda_prefetch
+        self.features_precomputed = False
+        self.audio_frontend = None
+        if gpu_features:
+            self.audio_frontend = MFCCFrontend(
+                numcep=26 if stack_audio else 13,
+                winlen=0.025 * 25 / fps,
+                winstep=0.010 * 25 / fps,
+                stack_order=4 if stack_audio else 1,
+            )
         # self.mask_face = mask_face
 
+    def prepare_data(self) -> None:
+        if not self.cache_features:
+            return
+
+        # parse the csv once and keep the typed DataFrame as a pickle next to it
+        if not self.metadata_cache_is_fresh():
+            metadata = self.read_metadata_csv()
+            try:
+                save_atomic(self.metadata_cache_path(), metadata.to_pickle)
+            except OSError as e:
+                # e.g. a read-only dataset mount, setup() then parses the csv
+                print(f"could not cache the metadata: {e}")
+
+        self.precompute_features()
+
+    def precompute_features(self):
+        # Lightning calls prepare_data on every fit / test entry, walk the caches only once per instance
+        if self.features_precomputed:
+            return
+        splits = split_new_dataset(df=self.load_metadata(), test_subset=self.test_subset)
+        for subset, metadata in zip(("train", "val", "test"), splits):
+            dataset = self.Dataset(
+                subset,
+                self.root,
+                metadata=metadata,
+                stack_audio=self.stack_audio,
+                raw_audio=self.gpu_features,
+            )
+            dataset.precompute_features()
+        self.features_precomputed = True
+
+    def metadata_cache_path(self):
+        return os.path.join(self.root, "meta_data_added.pkl")
+
+    def metadata_cache_is_fresh(self):
+        # the pickle is only trusted when it is not older than the csv, or the csv is gone
+        csv_path = os.path.join(self.root, "meta_data_added.csv")
+        try:
+            return not os.path.exists(csv_path) or os.path.getmtime(self.metadata_cache_path()) >= os.path.getmtime(
+                csv_path
+            )
+        except OSError:
+            return False
+
+    def read_metadata_csv(self):
+        metadata = pd.read_csv(os.path.join(self.root, "meta_data_added.csv"), dtype=dtype)  # .loc
+        metadata.columns = dtype.keys()
+        return metadata
+
+    def load_metadata(self):
+        if self.cache_features and self.metadata_cache_is_fresh():
+            try:
+                return pd.read_pickle(self.metadata_cache_path())
+            except OSError:
+                pass
+        return self.read_metadata_csv()
+
     def setup(self, stage: Optional[str] = None) -> None:
-        self.metadata = pd.read_csv(os.path.join(self.root, "meta_data_added.csv"), dtype=dtype)  # .loc
-        self.metadata.columns = dtype.keys()
+        self.metadata = self.load_metadata()
         # if self.dataset_type == "original":
         #     self.set_original_dataset()
         # elif self.dataset_type == "new":
@@ -359,6 +533,7 @@ class FakeavcelebDataModule(LightningDataModule):
             self.root,
             metadata=self.train_metadata,
             stack_audio=self.stack_audio,
+            raw_audio=self.gpu_features,
         )
 
         self.val_dataset = self.Dataset(
@@ -366,42 +541,67 @@ class FakeavcelebDataModule(LightningDataModule):
             self.root,
             metadata=self.val_metadata,
             stack_audio=self.stack_audio,
+            raw_audio=self.gpu_features,
         )
         self.test_dataset = self.Dataset(
             "test",
             self.root,
             metadata=self.test_metadata,
             stack_audio=self.stack_audio,
+            raw_audio=self.gpu_features,
         )
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # dequantize the uint8 frames on the GPU, with the normalization folded in
+        video = batch["video"].float()
+        batch["video"] = video.mul_(image_scale).add_(image_bias)
+        if self.audio_frontend is not None:
+            self.audio_frontend.to(batch["audio"].device)
+            with torch.no_grad():
+                batch["audio"] = self.audio_frontend(batch["audio"], batch["audio_length"])
+        return batch
+
     def train_dataloader(self) -> TRAIN_DATALOADERS:
-        return DataLoader(
+        loader = DataLoader(
             self.train_dataset,
+            collate_fn=self.train_dataset.collater,
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=self.num_workers,
+            pin_memory=True,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
             worker_init_fn=seed_worker,
             generator=g,
         )
+        if self.cuda_prefetch and torch.cuda.is_available():
+            return CUDAPrefetcher(loader, self.trainer.strategy.root_device)
+        return loader
 
     def val_dataloader(self) -> EVAL_DATALOADERS:
         if self.dataset_type == "original":
             return DataLoader(
                 self.test_dataset,
+                collate_fn=self.test_dataset.collater,
                 batch_size=self.batch_size,
                 shuffle=False,
                 num_workers=self.num_workers,
                 pin_memory=True,
+                persistent_workers=self.persistent_workers,
+                prefetch_factor=self.prefetch_factor,
                 worker_init_fn=seed_worker,
                 generator=g,
             )  # , worker_init_fn=seed_worker, generator=g
         else:
             return DataLoader(
                 self.val_dataset,
+                collate_fn=self.val_dataset.collater,
                 batch_size=self.batch_size,
                 shuffle=False,
                 num_workers=self.num_workers,
                 pin_memory=True,
+                persistent_workers=self.persistent_workers,
+                prefetch_factor=self.prefetch_factor,
                 worker_init_fn=seed_worker,
                 generator=g,
             )
@@ -409,10 +609,13 @@ class FakeavcelebDataModule(LightningDataModule):
     def test_dataloader(self) -> EVAL_DATALOADERS:
         return DataLoader(
             self.test_dataset,
+            collate_fn=self.test_dataset.collater,
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=self.num_workers,
             pin_memory=True,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
             worker_init_fn=seed_worker,
             generator=g,
         )
@@ -1,7 +1,10 @@
 import os
 
+import numpy as np
 import pandas as pd
 
+label_keys = ("v_label", "a_label", "c_label", "m_label", "mm_label", "s_label")
+
 
 def split_new_dataset(df, test_subset="all"):
 
@@ -85,3 +88,27 @@ def get_subject(row):
             return row["target1"]
         else:
             return row["source"]
+
+
+def get_labels(df):
+    """
+    Derive the labels of every sample at once from the type, method and category columns
+    Returns:
+    labels - numpy.ndarray of shape [N, len(label_keys)], int64, columns ordered as label_keys
+    """
+    real_video = df["type"].str.contains("RealVideo", regex=False, na=False).to_numpy()
+    real_audio = df["type"].str.contains("RealAudio", regex=False, na=False).to_numpy()
+    real_method = df["method"].str.contains("real", regex=False, na=False).to_numpy()
+
+    mm_label = np.select(
+        [
+            df["type"].str.contains(av_type, regex=False, na=False).to_numpy()
+            for av_type in ("RealVideo-RealAudio", "FakeVideo-RealAudio", "RealVideo-FakeAudio")
+        ],
+        [0, 1, 2],
+        default=3,
+    )
+    s_label = (df["category"] != "B").to_numpy()  # B: real_video-fake_audio
+
+    labels = [real_video, real_audio, real_video & real_audio, real_method, mm_label, s_label]
+    return np.stack(labels, axis=1).astype(np.int64)
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import python_speech_features
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchaudio
+
+
+class MFCCFrontend(nn.Module):
+    """
+    Batched torch version of python_speech_features.mfcc, so that the audio features can be
+    extracted on the GPU from the raw waveform instead of frame by frame in the dataloader workers.
+    Args:
+    numcep - int (number of cepstral coefficients to keep)
+    winlen, winstep - float (window length and step in seconds)
+    stack_order - int (number of neighboring frames to concatenate, see stacker)
+    """
+
+    def __init__(
+        self,
+        numcep=13,
+        sample_rate=16000,
+        winlen=0.025,
+        winstep=0.01,
+        nfilt=26,
+        nfft=512,
+        preemph=0.97,
+        ceplifter=22,
+        stack_order=1,
+    ):
+        super().__init__()
+        self.win_length = int(round(winlen * sample_rate))
+        self.hop_length = int(round(winstep * sample_rate))
+        self.nfft = nfft
+        self.preemph = preemph
+        self.stack_order = stack_order
+        self.eps = float(np.finfo(float).eps)
+
+        fbank = python_speech_features.get_filterbanks(nfilt, nfft, sample_rate)
+        self.register_buffer("fbank", torch.from_numpy(fbank.T).float())  # [nfft // 2 + 1, nfilt]
+
+        # fold the sinusoidal liftering into the DCT-II matrix
+        dct = torchaudio.functional.create_dct(numcep, nfilt, norm="ortho")  # [nfilt, numcep]
+        lift = 1 + (ceplifter / 2.0) * torch.sin(math.pi * torch.arange(numcep) / ceplifter)
+        self.register_buffer("dct", dct * lift)
+
+    def forward(self, wav, lengths=None):
+        """
+        Args:
+        wav - torch.Tensor of shape [B, S] (16kHz waveform)
+        lengths - torch.Tensor of shape [B] (number of valid samples, the rest is padding). If given,
+            the MFCC frames past the end of each signal are wrap-padded from its own frames, as
+            Fakeavceleb.load_audio does with the python_speech_features output
+        Returns:
+        feats - torch.Tensor of shape [B, T, F], or [B, F * stack_order, T / stack_order] if stacked
+        """
+        wav = wav.float()
+        wav = torch.cat([wav[:, :1], wav[:, 1:] - self.preemph * wav[:, :-1]], dim=1)
+        if lengths is not None:
+            # python_speech_features zero-fills the last partial frame after the pre-emphasis
+            positions = torch.arange(wav.shape[1], device=wav.device)
+            wav = wav.masked_fill(positions >= lengths[:, None], 0)
+
+        frames = wav.unfold(1, self.win_length, self.hop_length)  # [B, T, win_length]
+        pspec = torch.fft.rfft(frames, n=self.nfft).abs().pow(2) / self.nfft
+        energy = pspec.sum(-1).clamp_min(self.eps)
+
+        feats = torch.log(torch.matmul(pspec, self.fbank).clamp_min(self.eps))
+        feats = torch.matmul(feats, self.dct)
+        feats[..., 0] = torch.log(energy)
+
+        if lengths is not None:
+            # frames python_speech_features would give for each signal: 1 + ceil((S - win_length) / hop_length)
+            num_frames = 1 + torch.div(
+                (lengths - self.win_length).clamp_min(0) + self.hop_length - 1, self.hop_length, rounding_mode="floor"
+            )
+            index = torch.arange(feats.shape[1], device=feats.device) % num_frames[:, None]  # [B, T]
+            feats = torch.gather(feats, 1, index[..., None].expand(-1, -1, feats.shape[2]))
+
+        if self.stack_order > 1:
+            B, T, feat_dim = feats.shape
+            res = -T % self.stack_order
+            if res:
+                feats = F.pad(feats, (0, 0, 0, res))
+            feats = feats.reshape(B, -1, self.stack_order * feat_dim).transpose(1, 2)
+        return feats
@@ -0,0 +1,48 @@
+import torch
+
+
+class CUDAPrefetcher(object):
+    """
+    Wraps a DataLoader and copies batch N+1 to the GPU on a side CUDA stream while batch N is
+    being used, following the data_prefetcher of the apex ImageNet example.
+    The DataLoader should use pin_memory=True, otherwise the copies are not asynchronous.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # expose dataset, batch_size, sampler, ... of the wrapped loader
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        iterator = iter(self.loader)
+        next_batch = self.preload(iterator, stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    # allocated on the side stream, so tell the allocator it is used on this one too
+                    value.record_stream(current_stream)
+            next_batch = self.preload(iterator, stream)
+            yield batch
+
+    def preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return {
+                k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+                for k, v in batch.items()
+            }
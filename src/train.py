@@ -58,7 +58,8 @@ parser.add_argument("--num_workers", type=int, default=4)
 
 parser.add_argument("--gpu", type=int, default=2)
 
-parser.add_argument("--precision", default=16)
+parser.add_argument("--precision", default=None)
+parser.add_argument("--compile", action="store_true")
 parser.add_argument("--num_train", type=int, default=None)
 parser.add_argument("--num_val", type=int, default=None)
 parser.add_argument("--max_epochs", type=int, default=30)
@@ -89,12 +90,16 @@ parser.add_argument("--name", type=str, default="")
 
 parser.add_argument("--light", action="store_true")
 parser.add_argument("--random_seed", type=int, default=42)
+parser.add_argument("--deterministic", action="store_true")
 
 parser.add_argument("--oc_option", type=str, default="both")
 
 parser.add_argument("--file_name", type=str, default="")
 # parser.add_argument("--resnet3d", action="store_true")
 parser.add_argument("--scnet", action="store_true")
+parser.add_argument("--cache_features", action="store_true")
+parser.add_argument("--gpu_features", action="store_true")
+parser.add_argument("--cuda_prefetch", action="store_true")
 
 
 def dict_to_str(src_dict):
@@ -104,7 +109,7 @@ def dict_to_str(src_dict):
     return dst_str
 
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
     # seed init.
     random.seed(seed)
     np.random.seed(seed)
@@ -115,6 +120,11 @@ def set_seed(seed):
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
+    if not deterministic:
+        # let cuDNN pick the fastest kernels for the fixed input shapes
+        torch.backends.cudnn.benchmark = True
+        return
+
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.enabled = False  # train speed is slower after enabling this opts.
@@ -150,7 +160,7 @@ if __name__ == "__main__":
     }
 
     # for one_run in [42]:
-    set_seed(args.random_seed)
+    set_seed(args.random_seed, args.deterministic)
     name = f"{args.name}_{args.learning_rate}"
     wandb_name = f"{args.name}_{args.random_seed}"
 
@@ -213,12 +223,23 @@ if __name__ == "__main__":
         take_dev=args.num_val,
         dataset_type=args.dataset_type,
         stack_audio=args.stack_audio,
+        cache_features=args.cache_features,
+        gpu_features=args.gpu_features,
+        cuda_prefetch=args.cuda_prefetch,
     )
 
-    try:
-        precision = int(args.precision)
-    except ValueError:
-        precision = args.precision
+    if args.compile:
+        # input shapes are fixed (numFrames video / numFrames * 4 audio frames), so compile statically
+        model.forward = torch.compile(model.forward, mode="max-autotune", dynamic=False)
+
+    if args.precision is None:
+        # bf16 needs no grad scaling and does not overflow like fp16
+        precision = "bf16" if torch.cuda.is_bf16_supported() else 16
+    else:
+        try:
+            precision = int(args.precision)
+        except ValueError:
+            precision = args.precision
 
     monitor = "val_auroc"
     early_stop_callback = EarlyStopping(
@@ -242,9 +263,9 @@ if __name__ == "__main__":
             early_stop_callback,
         ],
         enable_checkpointing=True,
-        benchmark=True,
+        benchmark=not args.deterministic,
         num_sanity_val_steps=0,
-        deterministic="warn",
+        deterministic="warn" if args.deterministic else False,
         accelerator="auto",
         devices=[0],
         logger=wandb_logger,
@@ -254,7 +275,7 @@ if __name__ == "__main__":
 
     # test
     model.eval()
-    result = trainer.test(model, dm.test_dataloader(), ckpt_path="best")
+    result = trainer.test(model, datamodule=dm, ckpt_path="best")
     results.append(result)
     print(result)
 